@@ -91,7 +91,7 @@ def load_lookups(args, hier=False):
             
     c2ind = {str(c):i for i,c in ind2c.items()}
     c2ind_coarse = {str(c):i for i,c in ind2c_coarse.items()}
-    fine2coarse = np.zeros(len(ind2c))
+    fine2coarse = np.zeros(len(ind2c), dtype=np.int64)
     for idx, code in ind2c.items():
         idx_coarse = c2ind_coarse[code.split('.')[0]]
         fine2coarse[idx] = idx_coarse
@@ -263,6 +263,14 @@ class MimicDataset(Dataset):
     def __len__(self):
         return len(self.notes_labeled)
 
+    @property
+    def lengths(self):
+        #number of tokens of each document after truncation to max_len
+        lengths = self.notes_labeled['TEXT'].apply(len).values
+        if self.max_len > -1:
+            lengths = np.minimum(lengths, self.max_len)
+        return lengths
+
     def __getitem__(self, idx):
         item = self.notes_labeled.iloc[[idx]]
 
@@ -287,12 +295,70 @@ class MimicDataset(Dataset):
         
         return data, target_fine, target_coarse, hadm_id, doc
 
-def collate(batch):
+class CachedMimicDataset(Dataset):
+    """
+        Flattened copy of a MimicDataset: the token ids and label indices of all documents are stored
+        back to back in contiguous arrays with per-document offsets, so that fetching an item is a slice
+        instead of a DataFrame lookup.
+    """
+
+    def __init__(self, dataset):
+        
+        print('caching {} documents'.format(len(dataset)))
+        
+        notes_labeled = dataset.notes_labeled
+        
+        self.num_labels_fine = dataset.num_labels_fine
+        self.num_labels_coarse = dataset.num_labels_coarse
+        self.max_len = dataset.max_len
+        
+        texts = notes_labeled['TEXT'].values
+        if self.max_len > -1:
+            texts = [text[:self.max_len] for text in texts]
+        
+        self.ids, self.offsets = self._flatten(texts)
+        self.labels_fine, self.offsets_fine = self._flatten(notes_labeled['LABELS'].values)
+        self.labels_coarse, self.offsets_coarse = self._flatten(notes_labeled['LABELS_COARSE'].values)
+        
+        self.hadm_ids = notes_labeled['HADM_ID'].values
+        self.docs = notes_labeled['TEXT_PLAIN'].tolist()
+
+    @staticmethod
+    def _flatten(arrays):
+        offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(a) for a in arrays])
+        flat = np.concatenate(arrays).astype(np.int32) if len(arrays) > 0 else np.zeros(0, dtype=np.int32)
+        return flat, offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        data = torch.from_numpy(self.ids[self.offsets[idx]:self.offsets[idx+1]]).long()
+        
+        target_fine = torch.zeros(self.num_labels_fine)
+        target_fine[torch.from_numpy(self.labels_fine[self.offsets_fine[idx]:self.offsets_fine[idx+1]]).long()] = 1
+        
+        target_coarse = torch.zeros(self.num_labels_coarse)
+        target_coarse[torch.from_numpy(self.labels_coarse[self.offsets_coarse[idx]:self.offsets_coarse[idx+1]]).long()] = 1
+        
+        return data, target_fine, target_coarse, self.hadm_ids[idx], self.docs[idx]
+
+def collate(batch, pad_multiple=128):
 
     data, target_fine, target_coarse, hadm_ids, docs = zip(*batch)
 
     data = torch.nn.utils.rnn.pad_sequence(data, batch_first=True, padding_value=0)
     
+    #round the padded length up so that batches share a few conv shapes for the cuDNN autotuner
+    pad = -data.size(1) % pad_multiple
+    if pad > 0:
+        data = F.pad(data, (0, pad), value=0)
+    
     target_fine = torch.stack(target_fine)
     target_coarse = torch.stack(target_coarse)
 
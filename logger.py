@@ -0,0 +1,21 @@
+"""
+    Tensorboard logging of epoch level metrics
+"""
+from torch.utils.tensorboard import SummaryWriter
+
+class Tensorboard:
+
+    def __init__(self, log_dir, flush_secs=60):
+        #events are queued in memory and written to disk by the writer's background thread
+        self.writer = SummaryWriter(log_dir, flush_secs=flush_secs)
+
+    def log_scalar(self, tag, value, step):
+        self.writer.add_scalar(tag, value, step)
+
+    def log_scalars(self, tag_scalar_dict, step):
+        #one event file for all tags, add_scalars would open a separate writer per tag
+        for tag, value in tag_scalar_dict.items():
+            self.writer.add_scalar(tag, value, step)
+
+    def close(self):
+        self.writer.close()
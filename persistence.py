@@ -192,6 +192,10 @@ def write_preds(hids, docs, attns, ys, yhats, yhats_raw, metrics, model_dir, fol
     #with open(model_dir + '/labels.json', 'w') as f:
     #    json.dump(labels, f, indent=1)
     
+    #attention is only collected when samples were requested
+    if len(attns) == 0:
+        return
+    
     metrics_df = pd.DataFrame(data={'id':hids, 'accuracy':metrics[0], 'precision':metrics[1], 'recall':metrics[2], 'f1':metrics[3]})
 
     docs_df = pd.DataFrame(data={'id':hids, 'text':docs, 'attention':attns, 'target':list(ys), 'prediction':list(yhats)})
@@ -215,7 +219,7 @@ def write_preds(hids, docs, attns, ys, yhats, yhats_raw, metrics, model_dir, fol
     #with open(out_path, 'w') as f:
     #    json.dump(output, f, indent=1)
 
-def save_everything(args, dicts, metrics_hist_all, model, optimizer, model_dir, params, criterion, metrics_codes=None, metrics_inst=None, hadm_ids=None, evaluate=False, test_only=False):
+def save_everything(args, dicts, metrics_hist_all, model, optimizer, model_dir, params, criterion, scaler=None, metrics_codes=None, metrics_inst=None, hadm_ids=None, evaluate=False, test_only=False):
     """
         Save metrics, model, params all in model_dir
     """
@@ -229,18 +233,20 @@ def save_everything(args, dicts, metrics_hist_all, model, optimizer, model_dir,
         print("saved metrics to directory %s\n" % (model_dir))
         return
         
-    sd = model.cpu().state_dict()
+    #copy the weights to the cpu instead of moving the model, so that its parameters stay where the compiled forward expects them
+    sd = {k : v.cpu() for k, v in model.state_dict().items()}
     torch.save(sd, os.path.join(model_dir, "model_last_epoch.pth"))
     
     sd_opt = optimizer.state_dict()
     sd_opt['epoch'] = metrics_hist_all[0]['epochs']
+    #the fp16 loss scale is stored with the optimizer state so that resumed runs keep it
+    if scaler is not None and scaler.is_enabled():
+        sd_opt['scaler'] = scaler.state_dict()
     torch.save(sd_opt, os.path.join(model_dir, "optim_last_epoch.pth"))
     
     #save the model with the best criterion metric
-    if not np.all(np.isnan(metrics_hist_all[1][criterion])):
+    if criterion in metrics_hist_all[1] and not np.all(np.isnan(metrics_hist_all[1][criterion])):
         if np.nanargmax(metrics_hist_all[1][criterion]) == len(metrics_hist_all[1][criterion]) - 1:
             torch.save(sd, os.path.join(model_dir, "model_best_{}.pth".format(criterion)))
             torch.save(sd_opt, os.path.join(model_dir, "optim_best_{}.pth".format(criterion)))
-    if args.gpu:
-        model.cuda()
     print("saved metrics, params, model, optmizer state to directory %s\n" % (model_dir))
@@ -4,33 +4,173 @@
 import torch
 from torch import optim
 from torch.utils.data import DataLoader
+from torch.utils.data import Sampler
 
 from datasets import MimicDataset
+from datasets import CachedMimicDataset
 from datasets import collate
 
 
 import argparse
 import os 
 import numpy as np
+import random
 import sys
 import time
 import json
 from tqdm import tqdm
-from collections import defaultdict
 
-#from logger import Tensorboard
 import datasets
 import evaluation
 import persistence
 import models
 
-num_workers = 0
+try:
+    import numba
+except ImportError:
+    numba = None
+
+#number of training batches between two reads of the running loss from the device
+print_every = 50
+
+class _Prefetch:
+    """
+        Wraps a DataLoader and copies the next batch to the GPU on a side stream
+        while the current batch is being processed on the default stream.
+        With keep_cpu the host copies of the targets are appended to each batch.
+    """
+    def __init__(self, loader, device, keep_cpu=False):
+        self.loader, self.device = loader, device
+        self.keep_cpu = keep_cpu
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        nxt = self._push(next(it, None))
+        while nxt is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            tup = nxt
+            for tensor in tup[:3]:
+                tensor.record_stream(torch.cuda.current_stream())
+            nxt = self._push(next(it, None))
+            yield tup
+
+    def _push(self, tup):
+        if tup is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            data, target, target_coarse, hadm_ids, docs = tup
+            tup_device = (data.to(self.device, non_blocking=True),
+                          target.to(self.device, non_blocking=True),
+                          target_coarse.to(self.device, non_blocking=True), hadm_ids, docs)
+        if self.keep_cpu:
+            return tup_device + (target, target_coarse)
+        return tup_device
+
+class _Harvest:
+    """
+        Copies the result tensors of a batch to pinned host buffers on a side stream. The copies of a batch
+        are only waited for when the next batch is pushed, so they overlap with its forward pass.
+        Two sets of buffers are used in turn, the arrays returned by push/pop are valid until the next push.
+        Pushed tensors are recorded on the copy stream, so the caching allocator does not hand their memory
+        out again before the copies have read it.
+    """
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.stream = torch.cuda.Stream()
+        self.buffers = [{}, {}]
+        self.turn = 0
+        self.pending = None
+
+    def push(self, tensors, batch):
+        """
+            Start copying tensors (name -> device tensor, batch first) and return the previous batch as (arrays, batch), or None
+        """
+        buffers = self.buffers[self.turn]
+        self.stream.wait_stream(torch.cuda.current_stream())
+        host = {}
+        with torch.cuda.stream(self.stream):
+            for name, tensor in tensors.items():
+                if name not in buffers:
+                    buffers[name] = torch.empty((self.batch_size,) + tuple(tensor.shape[1:]), dtype=tensor.dtype, pin_memory=True)
+                host[name] = buffers[name][:len(tensor)]
+                host[name].copy_(tensor, non_blocking=True)
+                tensor.record_stream(self.stream)
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        
+        done = self.pop()
+        self.pending = (event, host, batch)
+        self.turn = 1 - self.turn
+        return done
+
+    def pop(self):
+        """
+            Wait for the pending batch and return it as (arrays, batch), or None
+        """
+        if self.pending is None:
+            return None
+        event, host, batch = self.pending
+        self.pending = None
+        event.synchronize()
+        return {name : tensor.numpy() for name, tensor in host.items()}, batch
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _coarsify(yhat_raw, fine2coarse, n_coarse):
+        #CPU version of the coarse predictions derived in test(): a coarse code is predicted if any of its fine codes is
+        B, Cf = yhat_raw.shape
+        out = np.zeros((B, n_coarse), dtype=np.float32)
+        for i in numba.prange(B):
+            for j in range(Cf):
+                if yhat_raw[i, j] > 0.5:
+                    out[i, fine2coarse[j]] = 1.0
+        return out
+
+class LengthBucketSampler(Sampler):
+    """
+        Batch sampler that groups documents of similar length to reduce padding.
+        When shuffling, the dataset is permuted and cut into chunks of batch_size*chunk_batches examples,
+        each chunk is sorted by length and split into batches, and the order of the batches is shuffled.
+        Otherwise, with sort the whole dataset is sorted by length (for evaluation), and without it
+        the batches follow the dataset order.
+    """
+    def __init__(self, lengths, batch_size, shuffle, sort=False, chunk_batches=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sort = sort
+        self.chunk_size = batch_size * chunk_batches
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            idx = np.random.permutation(len(self.lengths))
+            chunks = [idx[i:i+self.chunk_size] for i in range(0, len(idx), self.chunk_size)]
+        else:
+            chunks = [np.arange(len(self.lengths))]
+        
+        batches = []
+        for chunk in chunks:
+            if self.shuffle or self.sort:
+                chunk = chunk[np.argsort(self.lengths[chunk], kind='stable')]
+            batches.extend(chunk[i:i+self.batch_size].tolist() for i in range(0, len(chunk), self.batch_size))
+        
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        
+        return iter(batches)
 
 def main(args, reporter=None):
     start = time.time()
-    args, model, optimizer, params, dicts = init(args)
+    args, model, optimizer, scaler, params, dicts = init(args)
     
-    epochs_trained, metrics_hist_test = train_epochs(args, model, optimizer, params, dicts)
+    epochs_trained, metrics_hist_test = train_epochs(args, model, optimizer, scaler, params, dicts)
     elapsed = round(time.time() - start)
     m, s = divmod(elapsed, 60)
     h, m = divmod(m, 60)
@@ -41,27 +181,48 @@ def init(args):
     """
         Load data, build model, create optimizer, create vars to hold metrics, etc.
     """
+    
+    #let cuDNN autotune conv kernels and allow TF32 matmuls, unless results must be reproducible
+    #(collate pads documents to a multiple of 128 tokens, so the autotuned conv shapes repeat across batches)
+    if args.deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cuda.matmul.allow_tf32 = False
+        torch.backends.cudnn.allow_tf32 = False
+        torch.set_float32_matmul_precision('highest')
+    else:
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
 
     #load vocab and other lookups
     print("loading lookups...")
 
     dicts = datasets.load_lookups(args, hier=args.hier)
+    
+    #description tokens are uploaded once and reused by every train/test call
+    if args.embed_desc and args.gpu:
+        dicts['desc'] = dicts['desc'].pin_memory().cuda(non_blocking=True)
 
-    model, optimizer = init_model(args, dicts)
+    model, optimizer, scaler = init_model(args, dicts)
+    
+    if args.compile:
+        model = compile_model(model, args)
         
     print(model)
 
     params = vars(args)
     
-    return args, model, optimizer, params, dicts
+    return args, model, optimizer, scaler, params, dicts
 
-def train_epochs(args, model, optimizer, params, dicts):
+def train_epochs(args, model, optimizer, scaler, params, dicts):
     """
         Main loop. does train and test
     """
-    metrics_hist_train = defaultdict(list)
-    metrics_hist_dev = defaultdict(list)
-    metrics_hist_test = defaultdict(list)
+    metrics_hist_train = {}
+    metrics_hist_dev = {}
+    metrics_hist_test = {}
     
     if args.resume:
         metrics_file = os.path.join(os.path.dirname(os.path.abspath(args.resume)), 'metrics.json')
@@ -82,6 +243,11 @@ def train_epochs(args, model, optimizer, params, dicts):
     if not test_only:
         dataset_train = MimicDataset(args.data_path, dicts, num_labels_fine, num_labels_coarse, args.max_len)
         dataset_dev = MimicDataset(args.data_path.replace('train', 'dev'), dicts, num_labels_fine, num_labels_coarse, args.max_len)
+        if args.cache_tokens:
+            dataset_train, dataset_dev = CachedMimicDataset(dataset_train), CachedMimicDataset(dataset_dev)
+        #build the loaders once so that their worker pool is reused across epochs
+        train_loader = make_loader(dataset_train, args, shuffle=args.shuffle)
+        dev_loader = make_loader(dataset_dev, args, sort=True)
         if args.resume is None:
             model_dir = os.path.join(args.models_dir, '_'.join([args.model, time.strftime('%Y-%m-%d_%H:%M:%S')]))
             os.mkdir(model_dir)
@@ -90,34 +256,44 @@ def train_epochs(args, model, optimizer, params, dicts):
     else:
         model_dir = os.path.dirname(os.path.abspath(args.test_model))
 
-    #tensorboard = Tensorboard(model_dir)
+    if args.tensorboard:
+        #tensorboard is only imported when requested since it is an optional dependency
+        from logger import Tensorboard
+        tensorboard = Tensorboard(model_dir)
+    else:
+        tensorboard = None
     
     #train for n_epochs unless criterion metric does not improve for [patience] epochs
     for epoch in range(epoch, args.n_epochs if not test_only else 0):
    
-        losses = train(model, optimizer, args.Y, epoch, args.batch_size, args.embed_desc, dataset_train, args.shuffle, args.gpu, dicts)
-        loss = np.mean(losses)
+        loss = train(model, optimizer, args.Y, epoch, args.batch_size, args.embed_desc, train_loader, args.gpu, dicts, scaler, args.amp, args.accum_steps)
         
         metrics_train = {'loss': loss}
 
         fold ='dev'
 
-        #evaluate on dev
-        with torch.no_grad():
-            metrics_dev, _, _, _ = test(model, args.Y, epoch, dataset_dev, args.batch_size, args.embed_desc, fold, args.gpu, dicts, model_dir)
+        #evaluate on dev every eval_every epochs, and on each of the last patience+1 epochs
+        if epoch % args.eval_every == 0 or epoch >= args.n_epochs - args.patience - 1:
+            with torch.no_grad():
+                metrics_dev, _, _, _ = test(model, args.Y, epoch, dev_loader, args.batch_size, args.embed_desc, fold, args.gpu, dicts, model_dir, args.amp)
+        else:
+            #skipped epochs are recorded as nan so they are never picked as the best model
+            metrics_dev = {name : np.nan for name in metrics_hist_dev}
 
         for name, val in metrics_train.items():
-            #tensorboard.log_scalar('%s_train' % (name), val, epoch)
-            metrics_hist_train[name].append(metrics_train[name])
-            metrics_hist_train.update({'epochs': epoch+1})
+            metrics_hist_train.setdefault(name, []).append(val)
+        metrics_hist_train['epochs'] = epoch+1
         for name, val in metrics_dev.items():
-            #tensorboard.log_scalar('%s_dev' % (name), val, epoch)
-            metrics_hist_dev[name].append(metrics_dev[name])
+            metrics_hist_dev.setdefault(name, []).append(val)
+        
+        if tensorboard is not None:
+            tensorboard.log_scalars({'%s_train' % (name) : val for name, val in metrics_train.items()}, epoch)
+            tensorboard.log_scalars({'%s_dev' % (name) : val for name, val in metrics_dev.items() if not np.isnan(val)}, epoch)
 
         metrics_hist_all = (metrics_hist_train, metrics_hist_dev, None)
 
         #save metrics, model, optimizer state, params
-        persistence.save_everything(args, dicts, metrics_hist_all, model, optimizer, model_dir, params, args.criterion, evaluate=False, test_only=False)
+        persistence.save_everything(args, dicts, metrics_hist_all, model, optimizer, model_dir, params, args.criterion, scaler=scaler, evaluate=False, test_only=False)
 
         if args.criterion is not None:
             if early_stop(metrics_hist_dev, args.criterion, args.patience):
@@ -128,9 +304,9 @@ def train_epochs(args, model, optimizer, params, dicts):
     fold = 'test'            
     print("\nevaluating on test")
     
-    dataset_train = None
-    dataset_dev = None
-    del dataset_train, dataset_dev
+    dataset_train, train_loader = None, None
+    dataset_dev, dev_loader = None, None
+    del dataset_train, dataset_dev, train_loader, dev_loader
     
     if not test_only:
         model_best_sd = torch.load(os.path.join(model_dir, 'model_best_{}.pth'.format(args.criterion)))
@@ -140,18 +316,22 @@ def train_epochs(args, model, optimizer, params, dicts):
         model.cuda()
     
     dataset_test = MimicDataset(args.data_path.replace('train', 'test'), dicts, num_labels_fine, num_labels_coarse, args.max_len)
+    if args.cache_tokens:
+        dataset_test = CachedMimicDataset(dataset_test)
+    test_loader = make_loader(dataset_test, args, sort=True)
     
     with torch.no_grad():
-        metrics_test, metrics_codes, metrics_inst, hadm_ids = test(model, args.Y, epoch, dataset_test, args.batch_size, args.embed_desc,fold, args.gpu, dicts, model_dir)
+        metrics_test, metrics_codes, metrics_inst, hadm_ids = test(model, args.Y, epoch, test_loader, args.batch_size, args.embed_desc, fold, args.gpu, dicts, model_dir, args.amp, args.samples)
     
     for name, val in metrics_test.items():
-        #if not test_only:
-        #    tensorboard.log_scalar('%s_test' % (name), val, epoch)
-        metrics_hist_test[name].append(metrics_test[name])
+        metrics_hist_test.setdefault(name, []).append(val)
     
     metrics_hist_all = (metrics_hist_train, metrics_hist_dev, metrics_hist_test)
 
-    #tensorboard.close()
+    if tensorboard is not None:
+        if not test_only:
+            tensorboard.log_scalars({'%s_test' % (name) : val for name, val in metrics_test.items()}, epoch)
+        tensorboard.close()
         
     #save metrics, model, params
     persistence.save_everything(args, dicts, metrics_hist_all, model, optimizer, model_dir, params, args.criterion, metrics_codes=metrics_codes, metrics_inst=metrics_inst, hadm_ids=hadm_ids, evaluate=True, test_only=test_only)
@@ -160,73 +340,110 @@ def train_epochs(args, model, optimizer, params, dicts):
 
 def early_stop(metrics_hist, criterion, patience):
     
-    assert len(metrics_hist[criterion]) > 0
-        
-    #keep training if criterion results have all been nan so far
-    if np.all(np.isnan(metrics_hist[criterion])):
+    if criterion not in metrics_hist:
+        return False
+    
+    #patience counts evaluated epochs, epochs skipped by --eval-every (and nan results) are left out
+    hist = np.array(metrics_hist[criterion], dtype=float)
+    hist = hist[~np.isnan(hist)]
+    
+    #not enough evaluations yet to have waited [patience] of them for an improvement
+    #(this also keeps training if criterion results have all been nan so far)
+    if len(hist) < patience+1:
         return False
         
     if criterion == 'loss_dev': 
-        return np.nanargmin(metrics_hist[criterion]) > len(metrics_hist[criterion]) - patience
+        return np.argmin(hist) > len(hist) - patience
     else:
-        return np.nanargmax(metrics_hist[criterion]) < len(metrics_hist[criterion]) - patience
+        return np.argmax(hist) < len(hist) - patience
+
+def _worker_init(worker_id):
+    #torch seeds each worker differently, numpy and random are seeded from it
+    seed = torch.initial_seed() & 0xFFFFFFFF
+    np.random.seed(seed)
+    random.seed(seed)
+
+def make_loader(dataset, args, shuffle=False, sort=False):
+    """
+        Build a DataLoader for dataset. Shuffled batches are bucketed by document length, sort orders
+        the whole dataset by length (only for evaluation, training order is left alone). With num_workers > 0
+        the workers are kept alive between epochs and each of them keeps prefetch_factor batches in flight.
+    """
+    kwargs = {}
+    if args.num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=args.prefetch_factor, worker_init_fn=_worker_init)
+        #fork is the cheap default on linux, elsewhere forkserver avoids a full spawn per worker (not available on windows)
+        if sys.platform != 'linux' and 'forkserver' in torch.multiprocessing.get_all_start_methods():
+            kwargs.update(multiprocessing_context=torch.multiprocessing.get_context('forkserver'))
+    
+    sampler = LengthBucketSampler(dataset.lengths, args.batch_size, shuffle, sort=sort)
+
+    return DataLoader(dataset, batch_sampler=sampler, num_workers=args.num_workers, collate_fn=collate, pin_memory=True, **kwargs)
 
-def train(model, optimizer, Y, epoch, batch_size, embed_desc, dataset, shuffle, gpu, dicts):
+def autocast(amp):
+    """
+        Mixed precision context for the forward pass, amp is one of 'none', 'bf16', 'fp16'
+    """
+    return torch.amp.autocast('cuda', enabled=amp != 'none', dtype=torch.bfloat16 if amp == 'bf16' else torch.float16)
+
+def train(model, optimizer, Y, epoch, batch_size, embed_desc, gen, gpu, dicts, scaler, amp='none', accum_steps=1):
     """
         Training loop.
-        output: losses for each example for this iteration
+        output: mean loss over the batches of this epoch
     """
     print("EPOCH %d" % epoch)
     
-    #accumulation_steps = batch_size/8
-    #assert batch_size % 8 == 0
-    #optimizer.zero_grad()
-    #batch_size = 8
-
-    losses = []
+    #losses are summed on the device and only read back every print_every batches
+    loss_accum = torch.zeros((), device='cuda' if gpu else 'cpu')
+    loss_total = 0.0
+    last_print = 0
 
     ind2w, w2ind, ind2c, c2ind, desc = dicts['ind2w'], dicts['w2ind'], dicts['ind2c'], dicts['c2ind'], dicts['desc']
 
     model.train()
-    gen = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, collate_fn=collate, pin_memory=True)
+    if gpu:
+        gen = _Prefetch(gen, torch.device('cuda'))
         
     desc_data = desc
-    if embed_desc and gpu:
-        desc_data = desc_data.cuda()
+    
+    #gradients are accumulated over accum_steps batches before every optimizer step
+    optimizer.zero_grad(set_to_none=True)
     
     t = tqdm(gen, total=len(gen), ncols=0, file=sys.stdout)
     for batch_idx, tup in enumerate(t):
 
         data, target, target_coarse, _, _ = tup
 
-        if gpu:
-            data, target, target_coarse = data.cuda(), target.cuda(), target_coarse.cuda()
-        
         seq_length = data.size()[1]
         
-        optimizer.zero_grad()
-
-        if model.hier:
-            _, loss, _ = model(data, target, target_coarse, desc_data=desc_data)
+        with autocast(amp):
+            if model.hier:
+                _, loss, _ = model(data, target, target_coarse, desc_data=desc_data)
 
-        else:
-            _, loss, _ = model(data, target, desc_data=desc_data)
+            else:
+                _, loss, _ = model(data, target, desc_data=desc_data)
         
         del data, target, target_coarse
-        #loss = loss / accumulation_steps 
-        loss.backward()
-        losses.append(loss.item())
+        loss_accum += loss.detach()
+        #the last group of the epoch may hold fewer than accum_steps batches
+        group_size = min(accum_steps, len(gen) - (batch_idx // accum_steps) * accum_steps)
+        scaler.scale(loss / group_size).backward()
         del loss
         
-        #if (batch_idx+1) % accumulation_steps == 0 or batch_size < 16:
-        optimizer.step()
-        #    optimizer.zero_grad()
+        if (batch_idx+1) % accum_steps == 0 or batch_idx+1 == len(gen):
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
         
-        t.set_postfix(batch_size=batch_size, seq_length=seq_length, loss=np.mean(losses))
+        if (batch_idx+1) % print_every == 0 or batch_idx+1 == len(gen):
+            loss_total += loss_accum.item()
+            loss_accum.zero_()
+            last_print = batch_idx+1
+            t.set_postfix(batch_size=batch_size, seq_length=seq_length, loss=loss_total/last_print)
     
-    return losses
+    return loss_total / max(last_print, 1)
 
-def test(model, Y, epoch, dataset, batch_size, embed_desc, fold, gpu, dicts, model_dir):
+def test(model, Y, epoch, gen, batch_size, embed_desc, fold, gpu, dicts, model_dir, amp='none', samples=False):
     """
         Testing loop.
         Returns metrics
@@ -234,56 +451,98 @@ def test(model, Y, epoch, dataset, batch_size, embed_desc, fold, gpu, dicts, mod
 
     print('file for evaluation: %s' % fold)
 
-    docs, attention, y, yhat, yhat_raw, hids, losses = [], [], [], [], [], [], []
-
-    y_coarse, yhat_coarse, yhat_coarse_raw = [], [], []
+    docs, attention, hids = [], [], []
 
     ind2w, w2ind, ind2c, c2ind, desc = dicts['ind2w'], dicts['w2ind'], dicts['ind2c'], dicts['c2ind'], dicts['desc']
 
+    #results are written batch by batch into arrays sized for the whole dataset
+    num_examples = len(gen.dataset)
+    num_labels_fine = len(ind2c)
+    num_labels_coarse = len(dicts['ind2c_coarse'])
+    
+    y = np.empty((num_examples, num_labels_fine), dtype=np.float32)
+    yhat = np.empty((num_examples, num_labels_fine), dtype=np.uint8)
+    yhat_raw = np.empty((num_examples, num_labels_fine), dtype=np.float32)
+    y_coarse = np.empty((num_examples, num_labels_coarse), dtype=np.float32)
+    yhat_coarse = np.empty((num_examples, num_labels_coarse), dtype=np.uint8)
+    yhat_coarse_raw = np.empty((num_examples, num_labels_coarse), dtype=np.float32)
+    losses = np.empty(len(gen))
+    cur = 0
+
     model.eval()
 
-    gen = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate)
+    #targets are read back from the host copies made by the loader, not from the device
+    if gpu:
+        gen = _Prefetch(gen, torch.device('cuda'), keep_cpu=True)
 
     desc_data = desc
-    if embed_desc and gpu:
-        desc_data = desc_data.cuda()
+    
+    #coarse index of each fine code, used to derive coarse predictions for non-hierarchical models
+    fine2coarse = torch.from_numpy(dicts['fine2coarse']).to('cuda' if gpu else 'cpu')
+    
+    #attention is only copied back for the codes written out as qualitative samples
+    save_attention = fold == 'test' and samples
+    if save_attention:
+        codes_samples_idx = [dicts['c2ind'][c] for c in persistence.get_codes()]
 
+    if gpu:
+        harvest = _Harvest(batch_size)
+    
     t = tqdm(gen, total=len(gen), ncols=0, file=sys.stdout)
-    for batch_idx, tup in enumerate(t):
-        data, target, target_coarse, hadm_ids, data_text = tup
+    
+    def store(results, batch):
+        #save predictions, target, hadm ids
+        batch_idx, start, n, target_cpu, target_coarse_cpu, hadm_ids, data_text = batch
+        yhat_raw[start:start+n] = results['yhat_raw']
+        yhat[start:start+n] = results['yhat']
+        y[start:start+n] = target_cpu.numpy()
+        yhat_coarse_raw[start:start+n] = results['yhat_coarse_raw']
+        yhat_coarse[start:start+n] = results['yhat_coarse']
+        y_coarse[start:start+n] = target_coarse_cpu.numpy()
+        losses[batch_idx] = results['loss'][0]
         
+        hids.extend(hadm_ids)
+        docs.extend(data_text)
+        
+        t.set_postfix(loss=np.mean(losses[:batch_idx+1]))
+    
+    for batch_idx, tup in enumerate(t):
         if gpu:
-            data, target, target_coarse = data.cuda(), target.cuda(), target_coarse.cuda()
-
-        model.zero_grad()
-
-        if model.hier:
-            output, loss, alpha = model(data, target, target_coarse, desc_data=desc_data)
+            data, target, target_coarse, hadm_ids, data_text, target_cpu, target_coarse_cpu = tup
         else:
-            output, loss, alpha = model(data, target, desc_data=desc_data)
+            data, target, target_coarse, hadm_ids, data_text = tup
+            target_cpu, target_coarse_cpu = target, target_coarse
+        
+        with autocast(amp):
+            if model.hier:
+                output, loss, alpha = model(data, target, target_coarse, desc_data=desc_data)
+            else:
+                output, loss, alpha = model(data, target, desc_data=desc_data)
 
+        #metrics are computed in full precision
         if model.hier:
             output, output_coarse = output
-            output_coarse = output_coarse.data.cpu().numpy()
+            output, output_coarse = output.float(), output_coarse.float()
             alpha, alpha_coarse = alpha
         else:
-            output_coarse = np.zeros([len(output), len(dicts['ind2c_coarse'])])
-            for i, y_hat_raw_ in enumerate(output.data.cpu().numpy()):
-                if len(np.nonzero(np.round(y_hat_raw_))) == 0:
-                    continue
-                codes = [str(dicts['ind2c'][ind]) for ind in np.nonzero(np.round(y_hat_raw_))[0]]
-                codes_coarse = set(str(code).split('.')[0] for code in codes)
-                codes_coarse_idx = [dicts['c2ind_coarse'][code_coarse] for code_coarse in codes_coarse]
-                output_coarse[i, codes_coarse_idx] = 1
-
-        target_coarse_data = target_coarse.data.cpu().numpy()
-        y_coarse.append(target_coarse_data)
-        yhat_coarse_raw.append(output_coarse)
-        yhat_coarse.append(np.round(output_coarse))
+            output = output.float()
+            #a coarse code is predicted if any of its fine codes is (same threshold as np.round)
+            if not gpu and numba is not None:
+                output_coarse = torch.from_numpy(_coarsify(output.data.numpy(), dicts['fine2coarse'], num_labels_coarse))
+            else:
+                output_coarse = torch.zeros(len(output), num_labels_coarse, device=output.device)
+                output_coarse.index_add_(1, fine2coarse, (output.data > 0.5).float())
+                output_coarse = (output_coarse > 0).float()
+
+        n = len(output)
+        
+        #predictions are thresholded on the device and copied back as uint8
+        results = {'yhat_raw': output.data, 'yhat': (output.data > 0.5).to(torch.uint8),
+                   'yhat_coarse_raw': output_coarse.data, 'yhat_coarse': (output_coarse.data > 0.5).to(torch.uint8),
+                   'loss': loss.detach().float().reshape(1)}
+        batch = (batch_idx, cur, n, target_cpu, target_coarse_cpu, hadm_ids, data_text)
+        cur += n
         
-        losses.append(loss.item())
-        target_data = target.data.cpu().numpy()
- 
         del data, loss
         
         #if fold == 'test':
@@ -295,32 +554,28 @@ def test(model, Y, epoch, dataset, batch_size, embed_desc, fold, gpu, dicts, mod
         
         del target
         
-        output = output.data.cpu().numpy()
-        
-        #save predictions, target, hadm ids
-        yhat_raw.append(output)
-        yhat.append(np.round(output))
-        y.append(target_data)
-        
-        hids.extend(hadm_ids)
-        docs.extend(data_text)
-        attention.extend(alpha[:,[dicts['c2ind'][c] for c in persistence.get_codes()]].cpu())
+        if save_attention:
+            attention.extend(alpha[:,codes_samples_idx].float().cpu().numpy())
         
-        t.set_postfix(loss=np.mean(losses))
+        #on gpu the results of this batch are copied back while the next batch runs, and the previous batch is stored
+        if gpu:
+            done = harvest.push(results, batch)
+        else:
+            done = {name : tensor.numpy() for name, tensor in results.items()}, batch
+        if done is not None:
+            store(*done)
+    
+    if gpu:
+        done = harvest.pop()
+        if done is not None:
+            store(*done)
     
     level = ''
     k = 5 if len(ind2c) == 50 else [8,15]
 
-    y_coarse = np.concatenate(y_coarse, axis=0)
-    yhat_coarse = np.concatenate(yhat_coarse, axis=0)
-    yhat_coarse_raw = np.concatenate(yhat_coarse_raw, axis=0)
     metrics_coarse, _, _ = evaluation.all_metrics(yhat_coarse, y_coarse, k=k, yhat_raw=yhat_coarse_raw, level='coarse')
     evaluation.print_metrics(metrics_coarse, level='coarse')
 
-    y = np.concatenate(y, axis=0)
-    yhat = np.concatenate(yhat, axis=0)
-    yhat_raw = np.concatenate(yhat_raw, axis=0)
-    
     #get metrics
     metrics, metrics_codes, metrics_inst = evaluation.all_metrics(yhat, y, k=k, yhat_raw=yhat_raw, level='fine')
     evaluation.print_metrics(metrics, level='fine')
@@ -377,16 +632,56 @@ def init_model(args, dicts):
         
     if not args.test_model and not args.model == 'dummy':
         optimizer = optim.Adam(model.parameters(), weight_decay=args.weight_decay, lr=args.lr)
+        #loss scaling is only needed for fp16, bf16 has the same exponent range as fp32
+        scaler = torch.amp.GradScaler('cuda', enabled=args.amp == 'fp16')
         if args.resume:
             model_dir = os.path.dirname(os.path.abspath(args.resume))
             model_file = os.path.basename(os.path.abspath(args.resume))
             sd_opt = torch.load(os.path.join(model_dir, model_file.replace('model', 'optim')))
             args.epoch = sd_opt.pop('epoch')
+            sd_scaler = sd_opt.pop('scaler', None)
+            if sd_scaler is not None and scaler.is_enabled():
+                scaler.load_state_dict(sd_scaler)
             optimizer.load_state_dict(sd_opt)
     else:
         optimizer = None
+        scaler = None
 
-    return model, optimizer
+    return model, optimizer, scaler
+    
+def compile_model(model, args):
+    """
+        Compile the forward pass of model with torch.compile. Only the bound forward is replaced,
+        so state dicts keep their keys and saved models stay loadable without compilation.
+        Falls back to eager mode when compiling the forward fails, on the first call in train mode
+        or the first call in eval mode. The backward graph is compiled lazily by the first
+        loss.backward(), so failures there are not caught and still abort training.
+    """
+    if args.model == 'dummy':
+        return model
+    
+    eager_forward = model.forward
+    #sequence length changes from batch to batch, so no CUDA graphs (one would be recorded per length)
+    compiled_forward = torch.compile(model.forward, dynamic=True)
+    #train and eval mode trace different graphs, each is compiled on its first call
+    pending_modes = {True, False}
+    
+    def forward(*inputs, **kwargs):
+        #compilation is lazy, backend errors (no triton, no C++ toolchain, graph breaks) only show up on the first call
+        try:
+            output = compiled_forward(*inputs, **kwargs)
+        except Exception as e:
+            print('torch.compile failed, running the model in eager mode ({})'.format(e))
+            model.forward = eager_forward
+            return eager_forward(*inputs, **kwargs)
+        pending_modes.discard(model.training)
+        if not pending_modes:
+            model.forward = compiled_forward
+        return output
+    
+    model.forward = forward
+        
+    return model
     
 def load_embeddings(embed_file, ind2w, embed_size, embed_normalize):
     word_embeddings = {}
@@ -397,7 +692,7 @@ def load_embeddings(embed_file, ind2w, embed_size, embed_normalize):
             line = line.rstrip().split()
             idx = len(line) - embed_size
             word = '_'.join(line[:idx]).lower().strip()
-            vec = np.array(line[idx:]).astype(np.float)
+            vec = np.array(line[idx:]).astype(float)
             word_embeddings[word] = vec
 
     W = np.zeros((vocab_size+2, embed_size))
@@ -422,6 +717,12 @@ def load_embeddings(embed_file, ind2w, embed_size, embed_normalize):
     
     return W
 
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return value
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="train a neural network on some clinical documents")
     parser.add_argument("data_path", type=str,
@@ -449,6 +750,8 @@ if __name__ == "__main__":
                         help="initial learning rate for Adam optimizer (default=1e-3)")
     parser.add_argument("--batch-size", type=int, required=False, dest="batch_size", default=16,
                         help="size of training batches")
+    parser.add_argument("--accum-steps", type=positive_int, required=False, dest="accum_steps", default=1,
+                        help="number of batches to accumulate gradients over before each optimizer step (default: 1)")
     parser.add_argument("--dropout", dest="dropout", type=lambda s: [float(drop) for drop in s.split(',')], required=False, default=[0.5],
                         help="optional specification of dropout (default: 0.5)")
     parser.add_argument("--test-model", type=str, dest="test_model", required=False, help="path to a saved model to load and evaluate")
@@ -469,6 +772,24 @@ if __name__ == "__main__":
     parser.add_argument("--exclude-non-billable", action="store_true", dest="exclude_non_billable")
     parser.add_argument("--include-invalid", action="store_true", dest="include_invalid")
     parser.add_argument("--layer-norm", action="store_true", dest="layer_norm")
+    parser.add_argument("--eval-every", type=positive_int, required=False, dest="eval_every", default=1,
+                        help="evaluate on the dev set every k epochs, the last patience+1 epochs are always evaluated (default: 1)")
+    parser.add_argument("--tensorboard", action="store_true", dest="tensorboard",
+                        help="optional flag to log epoch metrics to tensorboard in the model directory")
+    parser.add_argument("--samples", action="store_true", dest="samples",
+                        help="optional flag to save attention samples for the top codes on the test set")
+    parser.add_argument("--cache-tokens", action="store_true", dest="cache_tokens",
+                        help="optional flag to keep the token ids of each split in flat arrays for faster batch loading")
+    parser.add_argument("--num-workers", type=int, required=False, dest="num_workers", default=2,
+                        help="number of data loading worker processes, roughly physical cores / GPUs works best (default: 2)")
+    parser.add_argument("--prefetch-factor", type=int, required=False, dest="prefetch_factor", default=4,
+                        help="batches loaded in advance by each worker (default: 4)")
+    parser.add_argument("--amp", type=str, choices=["none", "bf16", "fp16"], required=False, dest="amp", default="none",
+                        help="mixed precision mode for training and evaluation (default: none)")
+    parser.add_argument("--deterministic", action="store_true", dest="deterministic",
+                        help="optional flag to use deterministic cuDNN kernels instead of autotuned TF32 ones")
+    parser.add_argument("--no-compile", action="store_false", dest="compile",
+                        help="optional flag to disable torch.compile of the model forward pass")
     args = parser.parse_args()
     command = ' '.join(['python'] + sys.argv)
     args.command = command